@@ -4,14 +4,207 @@
 检查ONNX模型的复杂度、输入输出尺寸等信息
 """
 
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
 import sys
 import os
+import tempfile
 
-def check_model_info(model_path):
-    """检查ONNX模型信息"""
+# 摘要缓存格式版本，摘要内容变化时递增
+SUMMARY_CACHE_VERSION = 2
+SUMMARY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rm_auto_attack', 'model_summary')
+
+def _static_shape(value_info, default=640):
+    """取张量形状，动态维度按batch=1、其余=default处理"""
+    dims = value_info.type.tensor_type.shape.dim
+    return [d.dim_value if d.dim_value > 0 else (1 if i == 0 else default)
+            for i, d in enumerate(dims)]
+
+def strip_weight_data(model, max_kept=1024):
+    """
+    清除大尺寸initializer的数据，只保留dims，返回 {名称: dims}
+    
+    shape inference只需要权重形状；元素数不超过max_kept的小张量（Reshape/Resize的形状、缩放参数等）
+    保留数据，避免下游节点的形状无法推断。
+    """
+    weight_dims = {}
+    for tensor in model.graph.initializer:
+        weight_dims[tensor.name] = list(tensor.dims)
+        volume = 1
+        for dim in tensor.dims:
+            volume *= dim
+        if volume > max_kept:
+            for field in ('raw_data', 'float_data', 'int32_data', 'int64_data', 'double_data'):
+                tensor.ClearField(field)
+    return weight_dims
+
+def count_flops(model_path, model, weight_dims):
+    """
+    计算模型FLOPs，返回(FLOPs, 统计方式)，无法计算时返回(None, None)
+    
+    安装了onnx_tool时逐算子统计MACs（onnx_tool会重新完整加载模型，内存占用约为模型大小的数倍，
+    在内存紧张的设备上可卸载onnx_tool）；否则通过shape inference只统计Conv层：
+    FLOPs = 2 * Cout * Cin/groups * Kh * Kw * Hout * Wout
+    model应已经过strip_weight_data，weight_dims为其返回值。
+    """
+    if importlib.util.find_spec('onnx_tool') is not None:
+        try:
+            return _count_flops_onnx_tool(model_path, model)
+        except Exception:
+            pass
+    
+    import onnx
+    try:
+        inferred = onnx.shape_inference.infer_shapes(model)
+    except Exception:
+        return None, None
+    
+    shapes = {vi.name: _static_shape(vi)
+              for vi in list(inferred.graph.value_info) + list(inferred.graph.output)}
+    
+    flops = 0
+    for node in inferred.graph.node:
+        if node.op_type != 'Conv' or len(node.input) < 2:
+            continue
+        weight = weight_dims.get(node.input[1])
+        output = shapes.get(node.output[0])
+        if weight is None or output is None or len(weight) != 4 or len(output) != 4:
+            continue
+        # 权重形状为 [Cout, Cin/groups, Kh, Kw]，已经包含groups
+        cout, cin_per_group, kh, kw = weight
+        batch, _, hout, wout = output
+        flops += 2 * batch * cout * cin_per_group * kh * kw * hout * wout
+    
+    if flops == 0:
+        return None, None
+    return flops, '仅Conv层'
+
+def _count_flops_onnx_tool(model_path, model):
+    """用onnx_tool逐算子统计FLOPs（= 2 * MACs）"""
+    import numpy as np
+    import onnx_tool
+    
+    initializer_names = {t.name for t in model.graph.initializer}
+    dummy_inputs = {inp.name: np.zeros(_static_shape(inp), dtype=np.float32)
+                    for inp in model.graph.input if inp.name not in initializer_names}
+    tool_model = onnx_tool.Model(model_path)
+    tool_model.graph.shape_infer(dummy_inputs)
+    tool_model.graph.profile()
+    macs = 0
+    for node in tool_model.graph.nodemap.values():
+        macs += node.macs[0] if isinstance(node.macs, (list, tuple)) else node.macs
+    return 2 * macs, 'onnx_tool'
+
+def count_ort_optimized_nodes(model_path):
+    """
+    用onnxruntime做基础图优化（与convert_to_tensorrt.py相同的ORT_ENABLE_BASIC级别），返回优化后的节点数
+    
+    需要创建完整的ORT会话（加载全部权重），内存占用较大，仅在 --ort-fusion 时调用。
+    未安装onnxruntime或优化失败时返回None
+    """
     try:
         import onnx
-        
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        opt_file = os.path.join(tmp_dir, 'optimized.onnx')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        options.optimized_model_filepath = opt_file
+        try:
+            ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            return len(onnx.load(opt_file, load_external_data=False).graph.node)
+        except Exception:
+            return None
+
+def load_graph_summary(model_path, ort_fusion=False):
+    """
+    提取报告所需的图信息
+    
+    节点类型一次性收集到numpy数组中，用np.unique完成统计。
+    结果以JSON缓存在 ~/.cache/rm_auto_attack/model_summary/ 下，缓存键包含格式版本、模型路径、
+    修改时间、文件大小以及可选依赖（onnx_tool/onnxruntime）是否已安装，重复检查同一模型时无需重新解析。
+    ort_fusion为True时额外统计ORT融合后的节点数。
+    """
+    import numpy as np
+    
+    model_path = os.path.abspath(model_path)
+    stat = os.stat(model_path)
+    cache_key = {
+        'version': SUMMARY_CACHE_VERSION,
+        'path': model_path,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'onnx_tool': importlib.util.find_spec('onnx_tool') is not None,
+        'ort_fusion': ort_fusion and importlib.util.find_spec('onnxruntime') is not None,
+    }
+    cache_file = os.path.join(SUMMARY_CACHE_DIR,
+                              hashlib.sha1(model_path.encode()).hexdigest()[:16] + '.json')
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                summary = json.load(f)
+            if summary.get('cache_key') == cache_key:
+                return summary
+        except (OSError, ValueError):
+            pass
+    
+    import onnx
+    
+    # 只需要图结构，不加载外部权重；先清除权重数据再做shape inference，避免复制整个模型
+    model = onnx.load(model_path, load_external_data=False)
+    weight_dims = strip_weight_data(model)
+    flops, flops_method = count_flops(model_path, model, weight_dims)
+    del model.graph.initializer[:]
+    
+    def tensor_info(value_info):
+        tensor_type = value_info.type.tensor_type
+        shape = [dim.dim_value if dim.dim_value > 0 else '?' for dim in tensor_type.shape.dim]
+        return value_info.name, shape, onnx.TensorProto.DataType.Name(tensor_type.elem_type)
+    
+    nodes = model.graph.node
+    op_types = np.fromiter((node.op_type for node in nodes), dtype=object, count=len(nodes))
+    unique_types, counts = np.unique(op_types, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    
+    summary = {
+        'cache_key': cache_key,
+        'inputs': [tensor_info(inp) for inp in model.graph.input],
+        'outputs': [tensor_info(out) for out in model.graph.output],
+        'num_nodes': len(nodes),
+        'node_types': [(str(unique_types[i]), int(counts[i])) for i in order],
+        'flops': flops,
+        'flops_method': flops_method,
+        'ort_nodes': count_ort_optimized_nodes(model_path) if cache_key['ort_fusion'] else None,
+    }
+    
+    try:
+        os.makedirs(SUMMARY_CACHE_DIR, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(summary, f, ensure_ascii=False)
+    except OSError:
+        pass
+    
+    return summary
+
+def check_model_info(model_path, ort_fusion=False):
+    """检查ONNX模型信息，输出先写入缓冲区，最后一次性写到stdout（串口终端上逐行print很慢）"""
+    buf = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(buf):
+            return _check_model_info(model_path, ort_fusion)
+    finally:
+        sys.stdout.write(buf.getvalue())
+        sys.stdout.flush()
+
+def _check_model_info(model_path, ort_fusion=False):
+    """检查ONNX模型信息"""
+    try:
         if not os.path.exists(model_path):
             print(f"错误: 模型文件不存在: {model_path}")
             return False
@@ -20,17 +213,18 @@ def check_model_info(model_path):
         print(f"文件大小: {os.path.getsize(model_path) / 1024 / 1024:.2f} MB")
         print()
         
-        model = onnx.load(model_path)
+        summary = load_graph_summary(model_path, ort_fusion)
+        flops, flops_method = summary['flops'], summary['flops_method']
+        num_nodes = summary['num_nodes']
         
         # 检查输入
         print("=" * 60)
         print("模型输入:")
         print("=" * 60)
-        for inp in model.graph.input:
-            shape = [dim.dim_value if dim.dim_value > 0 else '?' for dim in inp.type.tensor_type.shape.dim]
-            print(f"  名称: {inp.name}")
+        for name, shape, dtype in summary['inputs']:
+            print(f"  名称: {name}")
             print(f"  形状: {shape}")
-            print(f"  类型: {onnx.TensorProto.DataType.Name(inp.type.tensor_type.elem_type)}")
+            print(f"  类型: {dtype}")
             
             # 计算参数数量
             total_params = 1
@@ -45,11 +239,10 @@ def check_model_info(model_path):
         print("=" * 60)
         print("模型输出:")
         print("=" * 60)
-        for out in model.graph.output:
-            shape = [dim.dim_value if dim.dim_value > 0 else '?' for dim in out.type.tensor_type.shape.dim]
-            print(f"  名称: {out.name}")
+        for name, shape, dtype in summary['outputs']:
+            print(f"  名称: {name}")
             print(f"  形状: {shape}")
-            print(f"  类型: {onnx.TensorProto.DataType.Name(out.type.tensor_type.elem_type)}")
+            print(f"  类型: {dtype}")
             
             # 计算输出大小
             output_size = 1
@@ -64,14 +257,11 @@ def check_model_info(model_path):
         print("=" * 60)
         print("模型复杂度:")
         print("=" * 60)
-        node_types = {}
-        for node in model.graph.node:
-            node_type = node.op_type
-            node_types[node_type] = node_types.get(node_type, 0) + 1
-        
-        print(f"总节点数: {len(model.graph.node)}")
+        print(f"总节点数: {num_nodes}")
+        if summary.get('ort_nodes') is not None:
+            print(f"ORT融合后节点数: {summary['ort_nodes']} (减少 {num_nodes - summary['ort_nodes']})")
         print(f"节点类型分布:")
-        for node_type, count in sorted(node_types.items(), key=lambda x: -x[1]):
+        for node_type, count in summary['node_types']:
             print(f"  {node_type}: {count}")
         print()
         
@@ -82,31 +272,28 @@ def check_model_info(model_path):
         
         # 获取输入尺寸
         input_shape = []
-        for inp in model.graph.input:
-            for dim in inp.type.tensor_type.shape.dim:
-                if dim.dim_value > 0:
-                    input_shape.append(dim.dim_value)
+        for _, shape, _ in summary['inputs']:
+            input_shape.extend(dim for dim in shape if isinstance(dim, int))
         
         if len(input_shape) >= 4:
             batch, channels, height, width = input_shape[0], input_shape[1], input_shape[2], input_shape[3]
             
             print(f"输入尺寸: {batch}x{channels}x{height}x{width}")
             
-            # 计算FLOPs（粗略估计）
-            # YOLO模型的大致FLOPs = 输入尺寸^2 * 节点数 * 常数
-            pixels = height * width
-            estimated_flops = pixels * len(model.graph.node) * 1000  # 粗略估计
-            print(f"估计FLOPs: {estimated_flops / 1e9:.2f} GFLOPs")
+            if flops is not None:
+                print(f"FLOPs: {flops / 1e9:.2f} GFLOPs ({flops_method})")
+            else:
+                print("FLOPs: 无法计算（安装onnx_tool可获得完整统计: pip install onnx-tool）")
             
             # 性能建议
             print()
             print("性能建议:")
             if height > 640 or width > 640:
                 print("  ⚠️  输入尺寸较大，考虑降低到640x640或更小")
-            if len(model.graph.node) > 500:
+            if num_nodes > 500:
                 print("  ⚠️  模型节点数较多，考虑使用更小的模型")
-            if estimated_flops > 50:
-                print("  ⚠️  计算量较大，可能影响实时性能")
+            if flops is not None and flops > 100e9:
+                print("  ⚠️  计算量超过100 GFLOPs，可能影响实时性能")
             
             # 推断模型类型
             if "yolo" in model_path.lower() or "detect" in model_path.lower():
@@ -127,9 +314,12 @@ def check_model_info(model_path):
 
 if __name__ == '__main__':
     model_path = 'best.onnx'
+    # --ort-fusion: 额外统计onnxruntime融合后的节点数（需加载全部权重，内存占用较大）
+    ort_fusion = '--ort-fusion' in sys.argv
     
-    if len(sys.argv) > 1:
-        model_path = sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args:
+        model_path = args[0]
     
     # 尝试多个路径
     possible_paths = [
@@ -142,12 +332,12 @@ if __name__ == '__main__':
     found = False
     for path in possible_paths:
         if os.path.exists(path):
-            check_model_info(path)
+            check_model_info(path, ort_fusion)
             found = True
             break
     
     if not found:
         print(f"未找到模型文件: {model_path}")
         print("请确保模型文件存在，或指定正确的路径:")
-        print("  python3 check_model_performance.py /path/to/best.onnx")
+        print("  python3 check_model_performance.py /path/to/best.onnx [--ort-fusion]")
 
@@ -1,97 +1,973 @@
 #!/usr/bin/env python3
 """
 ONNX到TensorRT引擎转换工具
-使用方法: python3 convert_to_tensorrt.py [onnx_file] [engine_file]
+使用方法: python3 convert_to_tensorrt.py [onnx_file] [engine_file] [--fp32] [--int8 --calib DIR]
 """
 
 import tensorrt as trt
+import argparse
+import hashlib
+import json
 import sys
 import os
+import re
 
-def build_engine(onnx_file, engine_file, fp16_mode=True, max_workspace_size=1<<30):
+CALIB_IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.npy')
+
+# --tactic-sources 名称到 trt.TacticSource 成员名的映射
+TACTIC_SOURCES = {
+    'cublas': 'CUBLAS',
+    'cublasLt': 'CUBLAS_LT',
+    'cudnn': 'CUDNN',
+    'edge_mask_convolutions': 'EDGE_MASK_CONVOLUTIONS',
+    'jit_convolutions': 'JIT_CONVOLUTIONS',
+}
+
+class Int8Calibrator(trt.IInt8EntropyCalibrator2):
+    """
+    INT8熵校准器
+    
+    从目录读取代表性帧（图像或预处理好的.npy），按与C++端相同的方式预处理
+    （直接缩放、BGR->RGB、归一化到0~1、HWC->CHW），分批拷贝到GPU供TensorRT校准。
+    校准表缓存到cache_file，重新构建时直接复用，跳过校准过程。
+    """
+    
+    def __init__(self, calib_dir, cache_file, batch=8, input_size=640):
+        trt.IInt8EntropyCalibrator2.__init__(self)
+        import numpy as np
+        import pycuda.driver as cuda
+        import pycuda.autoinit  # noqa: F401  创建CUDA上下文
+        
+        self.np = np
+        self.cuda = cuda
+        self.cache_file = cache_file
+        self.batch = batch
+        self.input_size = input_size
+        self.files = sorted(
+            os.path.join(calib_dir, name) for name in os.listdir(calib_dir)
+            if name.lower().endswith(CALIB_IMAGE_EXTS)
+        ) if os.path.isdir(calib_dir) else []
+        self.index = 0
+        
+        shape = (batch, 3, input_size, input_size)
+        self.host_buffer = cuda.pagelocked_empty(shape, dtype=np.float32)
+        self.device_buffer = cuda.mem_alloc(self.host_buffer.nbytes)
+        
+        print(f"  校准数据: {calib_dir} ({len(self.files)} 帧, batch={batch})")
+        # 已有校准缓存时TensorRT直接读取缓存，不需要校准帧
+        if len(self.files) < batch and not os.path.exists(cache_file):
+            print(f"警告: 校准帧数 {len(self.files)} 少于一个batch ({batch})，无法进行INT8校准")
+    
+    def _load_frame(self, path):
+        """读取单帧并预处理为CHW float32"""
+        np = self.np
+        if path.endswith('.npy'):
+            frame = np.load(path).astype(np.float32)
+            return frame.reshape(3, self.input_size, self.input_size)
+        
+        import cv2
+        image = cv2.imread(path)
+        if image is None:
+            raise IOError(f"无法读取校准图像: {path}")
+        image = cv2.resize(image, (self.input_size, self.input_size))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return (image.astype(np.float32) / 255.0).transpose(2, 0, 1)
+    
+    def get_batch_size(self):
+        return self.batch
+    
+    def get_batch(self, names):
+        if self.index + self.batch > len(self.files):
+            return None
+        
+        for i, path in enumerate(self.files[self.index:self.index + self.batch]):
+            self.host_buffer[i] = self._load_frame(path)
+        self.index += self.batch
+        
+        self.cuda.memcpy_htod(self.device_buffer, self.host_buffer)
+        return [int(self.device_buffer)]
+    
+    def read_calibration_cache(self):
+        if os.path.exists(self.cache_file):
+            print(f"✓ 使用校准缓存: {self.cache_file}")
+            with open(self.cache_file, 'rb') as f:
+                return f.read()
+        return None
+    
+    def write_calibration_cache(self, cache):
+        with open(self.cache_file, 'wb') as f:
+            f.write(cache)
+        print(f"✓ 校准缓存已保存: {self.cache_file}")
+
+def query_gpu_memory():
+    """查询GPU 0的(空闲, 总)显存（字节），无法查询时返回None"""
+    try:
+        import pycuda.driver as cuda
+        import pycuda.autoinit  # noqa: F401
+        return cuda.mem_get_info()
+    except Exception:
+        pass
+    try:
+        from cuda import cudart
+        err, free, total = cudart.cudaMemGetInfo()
+        if err == cudart.cudaError_t.cudaSuccess:
+            return free, total
+    except Exception:
+        pass
+    return None
+
+def auto_workspace_size(fallback=1<<30, ratio=0.75, upper=8<<30):
+    """根据空闲显存选择工作空间大小：min(空闲 * ratio, upper)"""
+    mem_info = query_gpu_memory()
+    if mem_info is None:
+        print(f"警告: 无法查询GPU显存，使用默认工作空间 {fallback / (1<<30):.2f} GB")
+        return fallback
+    free, total = mem_info
+    size = int(min(free * ratio, upper))
+    print(f"  GPU显存: 空闲 {free / (1<<30):.2f} GB / 总计 {total / (1<<30):.2f} GB")
+    return size
+
+def query_gpu_name():
+    """查询GPU 0的名称，用于区分不同设备的计时缓存"""
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            name = pynvml.nvmlDeviceGetName(pynvml.nvmlDeviceGetHandleByIndex(0))
+        finally:
+            pynvml.nvmlShutdown()
+        return name.decode() if isinstance(name, bytes) else name
+    except Exception:
+        pass
+    try:
+        import pycuda.driver as cuda
+        import pycuda.autoinit  # noqa: F401
+        return cuda.Device(0).name()
+    except Exception:
+        return 'unknown_gpu'
+
+def default_timing_cache_path(engine_file):
+    """计时缓存路径: <engine>.<GPU名称>.trt<版本>.timing_cache，避免不同设备/版本间互相污染"""
+    gpu = re.sub(r'[^0-9A-Za-z]+', '_', query_gpu_name()).strip('_')
+    return f"{engine_file}.{gpu}.trt{trt.__version__}.timing_cache"
+
+def query_compute_capability():
+    """查询GPU 0的计算能力，如(8, 9)，无法查询时返回None"""
+    try:
+        import pycuda.driver as cuda
+        import pycuda.autoinit  # noqa: F401
+        return cuda.Device(0).compute_capability()
+    except Exception:
+        pass
+    try:
+        from cuda import cudart
+        err, prop = cudart.cudaGetDeviceProperties(0)
+        if err == cudart.cudaError_t.cudaSuccess:
+            return prop.major, prop.minor
+    except Exception:
+        pass
+    return None
+
+def platform_supports(builder, precision):
+    """
+    判断当前平台是否支持指定精度
+    
+    BF16需要Ampere（sm_80）及以上，FP8需要Ada/Hopper（sm_89）及以上，且TensorRT版本提供对应的BuilderFlag。
+    """
+    if precision == 'fp32':
+        return True
+    if precision == 'fp16':
+        return builder.platform_has_fast_fp16
+    if not hasattr(trt.BuilderFlag, precision.upper()):
+        return False
+    fast_attr = getattr(builder, f'platform_has_fast_{precision}', None)
+    if fast_attr is not None:
+        return fast_attr
+    capability = query_compute_capability()
+    if capability is None:
+        return False
+    return capability >= ((8, 9) if precision == 'fp8' else (8, 0))
+
+def quantize_types(network):
+    """
+    返回网络中Q/DQ量化节点的目标类型集合（'int8'/'fp8'）
+    
+    optimize_model.py导出的是INT8 Q/DQ模型，modelopt FP8_DEFAULT_CFG导出的是FP8 Q/DQ模型，
+    两者都表现为QUANTIZE层，需要按量化层的输出类型区分。
+    """
+    fp8_type = getattr(trt.DataType, 'FP8', None)
+    types = set()
+    for i in range(network.num_layers):
+        layer = network.get_layer(i)
+        if layer.type != trt.LayerType.QUANTIZE:
+            continue
+        layer.__class__ = trt.IQuantizeLayer
+        to_type = getattr(layer, 'to_type', None)
+        if to_type is None:
+            to_type = layer.get_output(0).dtype
+        types.add('fp8' if fp8_type is not None and to_type == fp8_type else 'int8')
+    return types
+
+def parse_shape(text):
+    """解析形如 1,3,640,640 的形状参数"""
+    try:
+        shape = tuple(int(dim) for dim in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的形状: {text}（示例: 1,3,640,640）")
+    if len(shape) != 4 or min(shape) <= 0:
+        raise argparse.ArgumentTypeError(f"形状必须是4个正整数 NCHW: {text}")
+    return shape
+
+def sidecar_path(artifact, kind):
+    """
+    附属文件路径: <产物完整文件名>.<类型>.json
+    
+    例如 best.onnx.export.json、best.engine.build.json、best.engine.meta.json、best.engine.io.json
+    """
+    return f"{artifact}.{kind}.json"
+
+def load_build_key(onnx_file, options):
+    """
+    读取optimize_model.py写出的ONNX元数据(<onnx>.export.json)，与构建选项组合成引擎缓存键
+    
+    序列化引擎只能在构建时的TensorRT版本和GPU上加载，两者都计入缓存键。
+    没有元数据时返回None（不做缓存判断）
+    """
+    meta_file = sidecar_path(onnx_file, 'export')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    return {'onnx_key': meta.get('key'), 'imgsz': meta.get('imgsz'), 'options': options,
+            'tensorrt': trt.__version__, 'gpu': query_gpu_name()}
+
+def engine_up_to_date(onnx_file, engine_file, build_key):
+    """引擎存在、比ONNX新且缓存键一致时无需重新构建"""
+    meta_file = sidecar_path(engine_file, 'build')
+    if build_key is None or not os.path.exists(engine_file) or not os.path.exists(meta_file):
+        return False
+    if os.path.getmtime(engine_file) <= os.path.getmtime(onnx_file):
+        return False
+    with open(meta_file) as f:
+        # 经过一次JSON序列化再比较（元组会被保存为列表）
+        return json.load(f) == json.loads(json.dumps(build_key))
+
+def reference_onnx(onnx_file):
+    """
+    返回构建FP32参考引擎所用的ONNX路径
+    
+    Q/DQ量化模型直接构建会重新启用INT8，参考引擎必须来自未量化的源模型，
+    即optimize_model.py在 <onnx>.export.json 中记录的fp32_onnx；找不到时返回None。
+    非量化模型返回原路径。
+    """
+    logger = trt.Logger(trt.Logger.ERROR)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse_from_file(onnx_file) or not quantize_types(network):
+        return onnx_file
+    
+    meta_file = sidecar_path(onnx_file, 'export')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        source = json.load(f).get('fp32_onnx')
+    if not source:
+        return None
+    source = os.path.join(os.path.dirname(onnx_file), source)
+    return source if os.path.exists(source) else None
+
+def has_qdq_nodes(model):
+    """ONNX模型是否包含QuantizeLinear/DequantizeLinear量化节点"""
+    return any(node.op_type in ('QuantizeLinear', 'DequantizeLinear') for node in model.graph.node)
+
+def simplify_onnx(onnx_file):
+    """
+    常量折叠并简化ONNX模型，返回简化后的模型路径
+    
+    先优化FP32图再交给TensorRT，可以减少多余的Constant/Cast/Shape节点，缩短构建时间。
+    结果按原模型内容的sha1缓存为 <onnx>.<sha1>.sim.onnx，重复构建时直接复用。
+    onnxsim不可用时回退到polygraphy常量折叠，两者都不可用时返回原路径。
+    Q/DQ量化模型不做简化：常量折叠会把 DequantizeLinear(INT8权重) 折叠成FP32权重，丢失权重量化。
+    """
+    with open(onnx_file, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    sim_file = f"{os.path.splitext(onnx_file)[0]}.{digest}.sim.onnx"
+    if os.path.exists(sim_file):
+        print(f"✓ 使用已简化的ONNX: {sim_file}")
+        return sim_file
+    
+    try:
+        import onnx
+    except ImportError:
+        print("警告: 未安装onnx，跳过ONNX简化")
+        return onnx_file
+    
+    model = onnx.load(onnx_file)
+    if has_qdq_nodes(model):
+        print("  检测到Q/DQ量化节点，跳过ONNX简化")
+        return onnx_file
+    
+    print("简化ONNX模型...")
+    nodes_before = len(model.graph.node)
+    try:
+        import onnxsim
+        model, ok = onnxsim.simplify(model)
+        if not ok:
+            print("警告: onnxsim简化结果校验失败，使用原模型")
+            return onnx_file
+    except ImportError:
+        try:
+            from polygraphy.backend.onnx import fold_constants
+            model = fold_constants(model)
+        except ImportError:
+            print("警告: 未安装onnxsim或polygraphy，跳过ONNX简化")
+            return onnx_file
+    model = onnx.shape_inference.infer_shapes(model)
+    
+    onnx.save(model, sim_file)
+    print(f"✓ ONNX简化完成: 节点数 {nodes_before} -> {len(model.graph.node)}")
+    return sim_file
+
+def pre_optimize_onnx(onnx_file):
+    """
+    用onnxruntime做图优化（Conv+BN、Conv+Add/Mul融合、常量折叠等），返回优化后的模型路径
+    
+    只使用ORT_ENABLE_BASIC级别：更高级别会生成FusedConv等com.microsoft专有算子，TensorRT无法解析。
+    结果按原模型内容的sha1缓存为 <onnx>.<sha1>.opt.onnx；未安装onnxruntime时返回原路径。
+    Q/DQ量化模型与simplify_onnx一样跳过：ORT会调整Q/DQ节点的位置并复制DequantizeLinear，反而增加节点。
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("警告: 未安装onnxruntime，跳过ORT图优化")
+        return onnx_file
+    
+    with open(onnx_file, 'rb') as f:
+        data = f.read()
+    try:
+        import onnx
+        qdq = has_qdq_nodes(onnx.load_from_string(data))
+    except ImportError:
+        # 没有onnx时按算子名称判断（QuantizeLinear也是DequantizeLinear的子串）
+        qdq = b'QuantizeLinear' in data
+    if qdq:
+        print("  检测到Q/DQ量化节点，跳过ORT图优化")
+        return onnx_file
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    del data
+    opt_file = f"{os.path.splitext(onnx_file)[0]}.{digest}.opt.onnx"
+    if os.path.exists(opt_file):
+        print(f"✓ 使用已优化的ONNX: {opt_file}")
+        return opt_file
+    
+    print("ORT图优化...")
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = opt_file
+    try:
+        ort.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        print(f"警告: ORT图优化失败，使用原模型: {e}")
+        return onnx_file
+    print(f"✓ ORT图优化完成: {opt_file}")
+    return opt_file
+
+def tactic_source_mask(names):
+    """将逗号分隔的策略来源名称转换为 set_tactic_sources 所需的位掩码"""
+    mask = 0
+    for name in names.split(','):
+        name = name.strip()
+        if name not in TACTIC_SOURCES:
+            raise ValueError(f"未知的策略来源: {name}（可选: {', '.join(TACTIC_SOURCES)}）")
+        source = getattr(trt.TacticSource, TACTIC_SOURCES[name], None)
+        if source is None:
+            print(f"警告: 当前TensorRT版本不支持策略来源 {name}，已忽略")
+            continue
+        mask |= 1 << int(source)
+    return mask
+
+def write_engine_meta(engine_file, meta):
+    """写出引擎元数据 <engine>.meta.json，供C++推理端读取运行时约定"""
+    meta_file = sidecar_path(engine_file, 'meta')
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    print(f"  元数据: {meta_file}")
+
+def write_engine_io(engine_file, serialized):
+    """
+    写出引擎输入输出描述 <engine>.io.json，并打印各张量的格式
+    
+    推理端按其中的字节数预先分配锁页内存：输入用写合并内存（cudaHostAllocWriteCombined，
+    CPU只写、H2D更快），输出用映射内存（cudaHostAllocMapped，GPU直接写入主机内存，省去一次D2H拷贝）。
+    动态形状张量（包括输出）按优化配置的最大输入形状推出的形状计算字节数。
+    """
+    runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+    engine = runtime.deserialize_cuda_engine(bytes(serialized))
+    names = [engine.get_tensor_name(i) for i in range(engine.num_io_tensors)]
+    
+    # 只用于查询形状，不需要分配激活内存
+    if hasattr(engine, 'create_execution_context_without_device_memory'):
+        context = engine.create_execution_context_without_device_memory()
+    else:
+        context = engine.create_execution_context()
+    for name in names:
+        if engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT and -1 in tuple(engine.get_tensor_shape(name)):
+            context.set_input_shape(name, engine.get_tensor_profile_shape(name, 0)[2])
+    
+    tensors = []
+    print("  输入输出张量:")
+    for name in names:
+        is_input = engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT
+        shape = list(engine.get_tensor_shape(name))
+        dtype = engine.get_tensor_dtype(name)
+        volume = 1
+        for dim in context.get_tensor_shape(name):
+            volume *= dim
+        tensors.append({
+            'name': name,
+            'mode': 'in' if is_input else 'out',
+            'shape': shape,
+            'dtype': dtype.name,
+            'bytes': volume * trt.nptype(dtype)().itemsize,
+            'format': engine.get_tensor_format(name).name if hasattr(engine, 'get_tensor_format') else None,
+            'format_desc': engine.get_tensor_format_desc(name) if hasattr(engine, 'get_tensor_format_desc') else None,
+            'allocator': 'cudaHostAlloc(&ptr, bytes, cudaHostAllocWriteCombined)' if is_input else
+                         'cudaHostAlloc(&ptr, bytes, cudaHostAllocMapped); cudaHostGetDevicePointer(&dev, ptr, 0)',
+        })
+        print(f"    {name}: {tensors[-1]['format_desc'] or f'{dtype.name} {shape}'}")
+    
+    io_file = sidecar_path(engine_file, 'io')
+    with open(io_file, 'w') as f:
+        json.dump({
+            'notes': '输入使用写合并锁页内存，输出使用映射锁页内存（GPU直接写入主机内存），'
+                     '省去每帧一次cudaMemcpy；动态形状张量的bytes按最大输入形状计算，可直接用于预分配',
+            'tensors': tensors,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"  IO描述: {io_file}")
+
+def build_engine(onnx_file, engine_file, fp16_mode=True, max_workspace_size=None,
+                 precision=None,
+                 int8_mode=False, calib_dir=None, calib_cache=None, dla_core=None,
+                 simplify=True, opt_level=None, tactic_sources=None, timing_cache=None,
+                 min_shape=None, opt_shape=None, max_shape=None, sparse_weights=False,
+                 save=True, ort_optimize=True, direct_io=False):
     """
     从ONNX文件构建TensorRT引擎
     
     Args:
         onnx_file: ONNX模型文件路径
         engine_file: 输出的TensorRT引擎文件路径
-        fp16_mode: 是否使用FP16精度
-        max_workspace_size: 最大工作空间大小（字节）
+        fp16_mode: 是否使用FP16精度（precision为None时生效）
+        max_workspace_size: 最大工作空间大小（字节），None表示根据空闲显存自动选择
+        precision: auto/fp32/fp16/bf16/fp8，auto选择平台支持的最快精度；
+            fp8需要经modelopt（FP8_DEFAULT_CFG）量化后导出、带Q/DQ节点的ONNX
+        int8_mode: 是否使用INT8精度（需要校准数据或已有校准缓存）
+        calib_dir: INT8校准帧所在目录
+        calib_cache: INT8校准缓存路径，默认 <engine>.calib.cache
+        dla_core: 在指定DLA核心上构建（Jetson），不支持的层回退到GPU
+        simplify: 解析前是否先简化/常量折叠ONNX模型
+        opt_level: 构建优化等级0~5（TensorRT 8.6+），None使用默认值3
+        tactic_sources: 逗号分隔的策略来源，如 "cublas,cublasLt"，None使用默认值
+        timing_cache: 计时缓存文件路径，None按GPU名称和TensorRT版本自动生成
+        min_shape/opt_shape/max_shape: 动态输入的优化配置（NCHW），仅在ONNX输入为动态形状时生效；
+            默认 (1,3,416,416) / (1,3,640,640) / (4,3,640,640)
+        sparse_weights: 启用2:4结构化稀疏（Ampere及以上），ONNX权重需已按2:4模式剪枝
+        save: 是否保存引擎文件；False时只返回序列化结果（用于精度对比的参考引擎）
+        ort_optimize: 解析前是否先用onnxruntime融合Conv+BN等（在简化之后执行）
+        direct_io: 将网络输入输出限定为线性FP32并禁止TensorRT在此插入格式转换kernel
     """
-    TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+    # 稀疏模式下输出INFO日志，可在其中确认哪些层选用了稀疏kernel
+    TRT_LOGGER = trt.Logger(trt.Logger.INFO if sparse_weights else trt.Logger.WARNING)
     
     print(f"正在构建TensorRT引擎...")
     print(f"  输入: {onnx_file}")
     print(f"  输出: {engine_file}")
-    print(f"  FP16: {fp16_mode}")
+    if precision is None:
+        precision = 'fp16' if fp16_mode else 'fp32'
+    print(f"  精度: {precision}")
+    print(f"  INT8: {int8_mode}")
+    if dla_core is not None:
+        print(f"  DLA核心: {dla_core}")
     
     # 创建builder
     builder = trt.Builder(TRT_LOGGER)
     network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
     parser = trt.OnnxParser(network, TRT_LOGGER)
     
+    if simplify:
+        onnx_file = simplify_onnx(onnx_file)
+    if ort_optimize:
+        onnx_file = pre_optimize_onnx(onnx_file)
+    
     # 解析ONNX模型
     print("解析ONNX模型...")
-    with open(onnx_file, 'rb') as model:
-        if not parser.parse(model.read()):
-            print('错误: 解析ONNX文件失败')
-            for error in range(parser.num_errors):
-                print(f"  {parser.get_error(error)}")
-            return None
+    # 直接由解析器读取文件，避免先把整个模型读成Python bytes
+    if not parser.parse_from_file(onnx_file):
+        print('错误: 解析ONNX文件失败')
+        for error in range(parser.num_errors):
+            print(f"  {parser.get_error(error)}")
+        return None
     
     print(f"✓ ONNX模型解析成功")
     print(f"  输入层数: {network.num_inputs}")
     print(f"  输出层数: {network.num_outputs}")
     
+    # Q/DQ节点（optimize_model.py或modelopt量化导出）自带量化参数
+    qdq_types = quantize_types(network)
+    if 'int8' in qdq_types and not int8_mode:
+        # INT8 Q/DQ模型必须启用INT8标志才能按显式量化构建
+        print("✓ 检测到INT8 Q/DQ量化节点，自动启用INT8")
+        int8_mode = True
+    
     # 配置构建器
     config = builder.create_builder_config()
-    config.max_workspace_size = max_workspace_size
+    if max_workspace_size is None:
+        max_workspace_size = auto_workspace_size()
+    print(f"  工作空间: {max_workspace_size / (1<<30):.2f} GB")
+    if hasattr(config, 'set_memory_pool_limit'):
+        config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, max_workspace_size)
+    else:
+        config.max_workspace_size = max_workspace_size
+    
+    if dla_core is not None:
+        if dla_core >= builder.num_DLA_cores:
+            print(f"错误: DLA核心 {dla_core} 不存在（可用: {builder.num_DLA_cores}）")
+            return None
+        config.default_device_type = trt.DeviceType.DLA
+        config.DLA_core = dla_core
+        # YOLO检测头等DLA不支持的层回退到GPU
+        config.set_flag(trt.BuilderFlag.GPU_FALLBACK)
+        # DLA只支持FP16/INT8
+        precision = 'fp16'
+    
+    fp8_enabled = False
+    if precision == 'auto':
+        # FP8只能用于带FP8 Q/DQ节点的模型（没有可用的隐式校准）
+        candidates = ['fp8', 'fp16', 'fp32'] if 'fp8' in qdq_types else ['fp16', 'fp32']
+        precision = next(p for p in candidates if platform_supports(builder, p))
+        print(f"  自动选择精度: {precision}")
+    
+    if precision == 'fp8':
+        if 'fp8' not in qdq_types:
+            print("错误: FP8需要经modelopt量化（FP8_DEFAULT_CFG）后导出的带FP8 Q/DQ节点的ONNX模型")
+            return None
+        if platform_supports(builder, 'fp8'):
+            config.set_flag(trt.BuilderFlag.FP8)
+            fp8_enabled = True
+            print("✓ 启用FP8精度")
+        else:
+            print("警告: 平台不支持FP8，回退到FP16")
+        # 非FP8层使用FP16
+        precision = 'fp16'
     
-    if fp16_mode:
+    if precision == 'bf16':
+        if platform_supports(builder, 'bf16'):
+            config.set_flag(trt.BuilderFlag.BF16)
+            print("✓ 启用BF16精度")
+        else:
+            print("警告: 平台不支持BF16，回退到FP16")
+            precision = 'fp16'
+    
+    if precision == 'fp16':
         if builder.platform_has_fast_fp16:
             config.set_flag(trt.BuilderFlag.FP16)
+            if hasattr(trt.BuilderFlag, 'PREFER_PRECISION_CONSTRAINTS') and not int8_mode:
+                # PREFER_PRECISION_CONSTRAINTS只约束设置了layer.precision的层: 把计算量最大的
+                # 卷积/矩阵乘层约束为FP16，TensorRT尽量遵守，做不到时给出警告而不是静默选用FP32
+                constrained = 0
+                for i in range(network.num_layers):
+                    layer = network.get_layer(i)
+                    if layer.type in (trt.LayerType.CONVOLUTION, trt.LayerType.MATRIX_MULTIPLY):
+                        layer.precision = trt.float16
+                        constrained += 1
+                config.set_flag(trt.BuilderFlag.PREFER_PRECISION_CONSTRAINTS)
+                print(f"  FP16精度约束: {constrained} 个卷积/矩阵乘层")
             print("✓ 启用FP16精度")
         else:
             print("警告: 平台不支持FP16，使用FP32")
     
+    # 动态输入: 一个引擎覆盖416~640输入尺寸和batch 1~4
+    input_tensor = network.get_input(0)
+    profile = None
+    if -1 in tuple(input_tensor.shape):
+        _, channels, height, width = input_tensor.shape
+        channels = channels if channels > 0 else 3
+        if height > 0 and width > 0:
+            # 只有batch维是动态的
+            min_shape = min_shape or (1, channels, height, width)
+            opt_shape = opt_shape or (1, channels, height, width)
+            max_shape = max_shape or (4, channels, height, width)
+        else:
+            min_shape = min_shape or (1, channels, 416, 416)
+            opt_shape = opt_shape or (1, channels, 640, 640)
+            max_shape = max_shape or (4, channels, 640, 640)
+        profile = builder.create_optimization_profile()
+        profile.set_shape(input_tensor.name, min=min_shape, opt=opt_shape, max=max_shape)
+        config.add_optimization_profile(profile)
+        print(f"  动态输入 {input_tensor.name}: min={min_shape} opt={opt_shape} max={max_shape}")
+    elif min_shape or max_shape:
+        print(f"警告: 输入 {input_tensor.name} 为固定形状 {tuple(input_tensor.shape)}，"
+              f"忽略 --min/--opt/--max（导出ONNX时需使用 dynamic=True）")
+    
+    if int8_mode:
+        if builder.platform_has_fast_int8:
+            # INT8不支持的层回退到FP16（若已启用）或FP32
+            config.set_flag(trt.BuilderFlag.INT8)
+            # QDQ模型无需校准
+            cache_file = calib_cache or f"{engine_file}.calib.cache"
+            if 'int8' in qdq_types:
+                print("✓ 检测到INT8 Q/DQ量化节点，使用显式量化")
+            elif not calib_dir and not os.path.exists(cache_file):
+                print(f"错误: INT8模式需要校准数据目录 (--calib) 或校准缓存: {cache_file}")
+                return None
+            else:
+                if profile is not None:
+                    # 动态输入按opt形状校准
+                    calib_batch, input_size = opt_shape[0], opt_shape[-1]
+                    config.set_calibration_profile(profile)
+                else:
+                    # 固定输入时batch由输入形状决定（Ultralytics导出为1）
+                    calib_batch, input_size = input_tensor.shape[0], input_tensor.shape[-1]
+                config.int8_calibrator = Int8Calibrator(calib_dir or '', cache_file,
+                                                        batch=calib_batch, input_size=input_size)
+            print("✓ 启用INT8精度")
+        else:
+            print("警告: 平台不支持INT8，忽略INT8设置")
+    
+    if direct_io:
+        if hasattr(trt.BuilderFlag, 'DIRECT_IO'):
+            # DIRECT_IO只对限定了格式的IO张量生效: 固定为推理端使用的线性FP32布局
+            io_tensors = [network.get_input(i) for i in range(network.num_inputs)] + \
+                         [network.get_output(i) for i in range(network.num_outputs)]
+            for tensor in io_tensors:
+                tensor.dtype = trt.float32
+                tensor.allowed_formats = 1 << int(trt.TensorFormat.LINEAR)
+            config.set_flag(trt.BuilderFlag.DIRECT_IO)
+            print("✓ 启用DIRECT_IO（IO张量固定为线性FP32，格式见 .io.json）")
+        else:
+            print("警告: 当前TensorRT版本不支持DIRECT_IO，已忽略")
+    
+    if sparse_weights:
+        # 权重需事先用 torch.nn.utils.prune + apex.contrib.sparsity.ASP 剪枝为2:4模式，否则仍按稠密计算
+        config.set_flag(trt.BuilderFlag.SPARSE_WEIGHTS)
+        if hasattr(trt.BuilderFlag, 'REJECT_EMPTY_ALGORITHMS'):
+            # 没有可用策略时直接失败，而不是静默回退
+            config.set_flag(trt.BuilderFlag.REJECT_EMPTY_ALGORITHMS)
+        print("✓ 启用2:4结构化稀疏（在INFO日志中查找 sparse 确认稀疏kernel是否被选用）")
+    
+    if opt_level is not None:
+        if hasattr(config, 'builder_optimization_level'):
+            config.builder_optimization_level = opt_level
+            print(f"  优化等级: {opt_level}")
+        else:
+            print("警告: 当前TensorRT版本不支持builder_optimization_level，已忽略")
+    
+    if tactic_sources:
+        try:
+            config.set_tactic_sources(tactic_source_mask(tactic_sources))
+        except ValueError as e:
+            print(f"错误: {e}")
+            return None
+        print(f"  策略来源: {tactic_sources}")
+    
+    # 计时缓存: 复用之前构建得到的kernel计时结果，ONNX不变时重新构建只需几秒
+    cache = None
+    if hasattr(config, 'create_timing_cache'):
+        timing_cache = timing_cache or default_timing_cache_path(engine_file)
+        cache_blob = b""
+        if os.path.exists(timing_cache):
+            with open(timing_cache, 'rb') as f:
+                cache_blob = f.read()
+            print(f"✓ 使用计时缓存: {timing_cache}")
+        cache = config.create_timing_cache(cache_blob)
+        config.set_timing_cache(cache, ignore_mismatch=False)
+    
     # 构建引擎
     print("构建TensorRT引擎（这可能需要几分钟）...")
     try:
-        engine = builder.build_engine(network, config)
-        if engine is None:
+        if hasattr(builder, 'build_serialized_network'):
+            # TensorRT 8+: 直接得到序列化结果，避免额外构建一份内存中的引擎
+            serialized = builder.build_serialized_network(network, config)
+        else:
+            engine = builder.build_engine(network, config)
+            serialized = engine.serialize() if engine is not None else None
+        if serialized is None:
             print("错误: 构建引擎失败")
             return None
     except Exception as e:
         print(f"错误: {e}")
         return None
     
+    if cache is not None:
+        with open(timing_cache, 'wb') as f:
+            f.write(memoryview(cache.serialize()))
+        print(f"✓ 计时缓存已保存: {timing_cache}")
+    
+    # 释放构建期对象，之后反序列化引擎生成IO描述时不与builder/network同时占用内存
+    input_name = input_tensor.name
+    dynamic = profile is not None
+    del cache, profile, input_tensor, parser, network, config, builder
+    
+    if not save:
+        return serialized
+    
     # 保存引擎
     print(f"保存引擎到 {engine_file}...")
     with open(engine_file, 'wb') as f:
-        f.write(engine.serialize())
+        f.write(bytes(serialized))
     
     print(f"✓ TensorRT引擎构建完成: {engine_file}")
     print(f"  引擎大小: {os.path.getsize(engine_file) / 1024 / 1024:.2f} MB")
+    if dynamic:
+        print(f"  动态输入: 推理前需调用 context.set_input_shape('{input_name}', 实际形状)，"
+              f"形状范围 {min_shape} ~ {max_shape}")
+    
+    write_engine_io(engine_file, serialized)
     
-    return engine
+    # 固定形状的GPU引擎每帧输入输出形状都相同，推理端可以捕获一次CUDA Graph后逐帧重放，
+    # 减少每次enqueue的CPU提交开销；DLA引擎和动态形状引擎不适用
+    cuda_graph = not dynamic and dla_core is None
+    write_engine_meta(engine_file, {
+        'precision': 'fp8' if fp8_enabled else precision,
+        'int8': int8_mode,
+        'dla_core': dla_core,
+        'dynamic_input': None if not dynamic else {
+            'name': input_name, 'min': min_shape, 'opt': opt_shape, 'max': max_shape,
+        },
+        'cuda_graph': {
+            'recommended': cuda_graph,
+            'usage': [
+                'cudaStreamBeginCapture(stream, cudaStreamCaptureModeGlobal)',
+                'context->enqueueV3(stream)',
+                'cudaStreamEndCapture(stream, &graph)',
+                'cudaGraphInstantiate(&graphExec, graph, 0)',
+                'per frame: cudaGraphLaunch(graphExec, stream)',
+            ] if cuda_graph else [],
+        },
+    })
+    
+    return serialized
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("使用方法: python3 convert_to_tensorrt.py <onnx_file> [engine_file] [--fp32]")
-        print("示例: python3 convert_to_tensorrt.py best.onnx best.engine")
-        sys.exit(1)
+class EngineRunner:
+    """在单个CUDA流上运行序列化引擎，用CUDA Event计时（用于构建后的精度/速度验证）"""
     
-    onnx_file = sys.argv[1]
-    if len(sys.argv) > 2:
-        engine_file = sys.argv[2]
-    else:
-        engine_file = onnx_file.replace('.onnx', '.engine')
+    def __init__(self, serialized, input_shape=None):
+        import numpy as np
+        import pycuda.driver as cuda
+        import pycuda.autoinit  # noqa: F401
+        
+        self.np = np
+        self.cuda = cuda
+        self.runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        self.engine = self.runtime.deserialize_cuda_engine(bytes(serialized))
+        self.context = self.engine.create_execution_context()
+        self.stream = cuda.Stream()
+        
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.inputs = [n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT]
+        self.outputs = [n for n in names if n not in self.inputs]
+        
+        # 动态输入使用优化配置中的opt形状
+        for name in self.inputs:
+            shape = tuple(self.engine.get_tensor_shape(name))
+            if -1 in shape:
+                shape = input_shape or tuple(self.engine.get_tensor_profile_shape(name, 0)[1])
+            self.context.set_input_shape(name, shape)
+        
+        self.buffers = {}
+        for name in names:
+            dtype = trt.nptype(self.engine.get_tensor_dtype(name))
+            host = cuda.pagelocked_empty(tuple(self.context.get_tensor_shape(name)), dtype)
+            device = cuda.mem_alloc(host.nbytes)
+            self.context.set_tensor_address(name, int(device))
+            self.buffers[name] = (host, device)
+    
+    def input_shape(self):
+        return self.buffers[self.inputs[0]][0].shape
+    
+    def infer(self, data):
+        """执行一次推理，返回(各输出的float32副本, GPU耗时ms)"""
+        cuda = self.cuda
+        host, device = self.buffers[self.inputs[0]]
+        host[...] = data
+        cuda.memcpy_htod_async(device, host, self.stream)
+        
+        start, end = cuda.Event(), cuda.Event()
+        start.record(self.stream)
+        self.context.execute_async_v3(self.stream.handle)
+        end.record(self.stream)
+        
+        for name in self.outputs:
+            host, device = self.buffers[name]
+            cuda.memcpy_dtoh_async(host, device, self.stream)
+        self.stream.synchronize()
+        
+        outputs = [self.buffers[name][0].astype(self.np.float32) for name in self.outputs]
+        return outputs, start.time_till(end)
+
+def validate_engine(serialized, reference, runs=20, tolerance=0.05):
+    """
+    用随机输入对比目标精度引擎与FP32参考引擎的输出和延迟
+    
+    输出最大绝对误差超过 tolerance * FP32输出最大幅值，或目标引擎不比FP32快5%以上时判为失败。
+    返回是否通过验证。
+    """
+    import numpy as np
+    
+    print(f"验证引擎（{runs}组随机输入）...")
+    target_runner = EngineRunner(serialized)
+    reference_runner = EngineRunner(reference, target_runner.input_shape())
     
-    fp16_mode = '--fp32' not in sys.argv
+    max_diff = 0.0
+    max_ref = 0.0
+    target_times, reference_times = [], []
+    # 预热一次，不计入统计
+    warmup = np.random.randn(*target_runner.input_shape()).astype(np.float32)
+    target_runner.infer(warmup)
+    reference_runner.infer(warmup)
+    
+    for _ in range(runs):
+        data = np.random.randn(*target_runner.input_shape()).astype(np.float32)
+        target_outputs, target_ms = target_runner.infer(data)
+        reference_outputs, reference_ms = reference_runner.infer(data)
+        target_times.append(target_ms)
+        reference_times.append(reference_ms)
+        for out, ref in zip(target_outputs, reference_outputs):
+            max_diff = max(max_diff, float(np.max(np.abs(out - ref))))
+            max_ref = max(max_ref, float(np.max(np.abs(ref))))
+    
+    mean_target = sum(target_times) / runs
+    mean_reference = sum(reference_times) / runs
+    print(f"  max|目标 - fp32|: {max_diff:.6f}（FP32输出最大幅值 {max_ref:.4f}）")
+    print(f"  平均延迟: 目标 {mean_target:.3f} ms, fp32 {mean_reference:.3f} ms "
+          f"(加速 {mean_reference / mean_target:.2f}x)")
+    
+    passed = True
+    if max_diff > tolerance * max(max_ref, 1e-6):
+        print(f"✗ 输出误差超过阈值（{tolerance:.0%} 的输出幅值）")
+        passed = False
+    if mean_target > mean_reference * 0.95:
+        print("✗ 目标精度引擎没有明显快于FP32，检查层精度是否被提升或换用FP32")
+        passed = False
+    if passed:
+        print("✓ 验证通过")
+    return passed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ONNX到TensorRT引擎转换工具')
+    parser.add_argument('onnx_file', help='ONNX模型文件路径')
+    parser.add_argument('engine_file', nargs='?', help='输出引擎路径（默认与ONNX同名）')
+    parser.add_argument('--fp32', action='store_true', help='禁用FP16，使用FP32精度（等同于 --precision fp32）')
+    parser.add_argument('--precision', choices=['auto', 'fp32', 'fp16', 'bf16', 'fp8'],
+                        help='计算精度（默认fp16）；auto选择平台支持的最快精度，fp8需要modelopt量化的Q/DQ模型')
+    parser.add_argument('--int8', action='store_true', help='启用INT8精度（需要校准数据）')
+    parser.add_argument('--calib', help='INT8校准帧目录（图像或预处理好的.npy）')
+    parser.add_argument('--dla', type=int, default=0, metavar='N',
+                        help='额外为前N个DLA核心各构建一个引擎（Jetson Orin）')
+    parser.add_argument('--opt-level', type=int, choices=range(6), metavar='{0..5}',
+                        help='构建优化等级（TensorRT 8.6+，默认3；越高构建越慢，需实测效果）')
+    parser.add_argument('--tactic-sources',
+                        help=f"逗号分隔的策略来源: {','.join(TACTIC_SOURCES)}")
+    parser.add_argument('--timing-cache',
+                        help='计时缓存文件路径（默认 <engine>.<GPU>.trt<版本>.timing_cache）')
+    parser.add_argument('--min', type=parse_shape, metavar='N,C,H,W',
+                        help='动态输入的最小形状（默认 1,3,416,416）')
+    parser.add_argument('--opt', type=parse_shape, metavar='N,C,H,W',
+                        help='动态输入的最优形状（默认 1,3,imgsz,imgsz）')
+    parser.add_argument('--max', type=parse_shape, metavar='N,C,H,W',
+                        help='动态输入的最大形状（默认 4,3,640,640）')
+    parser.add_argument('--sparse-weights', action='store_true',
+                        help='启用2:4结构化稀疏（Ampere+，ONNX权重需已按2:4剪枝）')
+    parser.add_argument('--validate', action='store_true',
+                        help='构建后与FP32引擎对比输出误差和延迟，精度下降或没有加速时返回非零')
+    parser.add_argument('--validate-tol', type=float, default=0.05,
+                        help='--validate的相对误差阈值（相对FP32输出最大幅值，默认0.05）')
+    parser.add_argument('--direct-io', action='store_true',
+                        help='输入输出固定为线性FP32并禁止插入格式转换（实际格式记录在 .io.json 的format字段）')
+    parser.add_argument('--no-simplify', action='store_true', help='解析前不简化ONNX模型')
+    parser.add_argument('--no-ort-opt', action='store_true', help='解析前不使用onnxruntime做图优化')
+    parser.add_argument('--force', action='store_true', help='忽略缓存，强制重新构建')
+    parser.add_argument('--workspace-gb', type=float,
+                        help='工作空间大小（GB），默认根据空闲显存自动选择')
+    args = parser.parse_args()
+    
+    onnx_file = args.onnx_file
+    engine_file = args.engine_file or onnx_file.replace('.onnx', '.engine')
     
     if not os.path.exists(onnx_file):
         print(f"错误: ONNX文件不存在: {onnx_file}")
         sys.exit(1)
     
-    build_engine(onnx_file, engine_file, fp16_mode)
-
+    workspace = int(args.workspace_gb * (1<<30)) if args.workspace_gb else None
+    
+    # optimize_model.py记录的导出尺寸作为动态输入的默认最优形状
+    onnx_meta = sidecar_path(onnx_file, 'export')
+    if args.opt is None and os.path.exists(onnx_meta):
+        with open(onnx_meta) as f:
+            imgsz = json.load(f).get('imgsz')
+        if imgsz:
+            args.opt = (1, 3, imgsz, imgsz)
+    
+    precision = args.precision or ('fp32' if args.fp32 else 'fp16')
+    
+    build_options = {
+        'max_workspace_size': workspace,
+        'int8_mode': args.int8,
+        'calib_dir': args.calib,
+        'simplify': not args.no_simplify,
+        'ort_optimize': not args.no_ort_opt,
+        'opt_level': args.opt_level,
+        'tactic_sources': args.tactic_sources,
+        'min_shape': args.min,
+        'opt_shape': args.opt,
+        'max_shape': args.max,
+        'sparse_weights': args.sparse_weights,
+        'direct_io': args.direct_io,
+    }
+    
+    build_key = load_build_key(onnx_file, dict(build_options, precision=precision, dla=args.dla))
+    up_to_date = not args.force and engine_up_to_date(onnx_file, engine_file, build_key)
+    if up_to_date:
+        print(f"✓ 引擎已是最新，跳过构建: {engine_file}（使用 --force 强制重新构建）")
+        if not args.validate:
+            sys.exit(0)
+        # 仍需验证: 用已有引擎文件与新构建的FP32参考引擎对比
+        with open(engine_file, 'rb') as f:
+            engine = f.read()
+    else:
+        engine = build_engine(onnx_file, engine_file, precision=precision,
+                              timing_cache=args.timing_cache, **build_options)
+        if engine is None:
+            sys.exit(1)
+    
+    if args.validate:
+        reference_file = reference_onnx(onnx_file)
+        if precision == 'fp32' and not args.int8:
+            print("警告: 目标精度为FP32，跳过 --validate")
+        elif reference_file is None:
+            print(f"警告: {onnx_file} 是Q/DQ量化模型，但找不到未量化的源ONNX"
+                  f"（{sidecar_path(onnx_file, 'export')} 中的fp32_onnx），跳过 --validate")
+        else:
+            print(f"构建FP32参考引擎（不保存）: {reference_file}")
+            reference = build_engine(reference_file, engine_file, precision='fp32', save=False,
+                                     timing_cache=args.timing_cache,
+                                     **dict(build_options, int8_mode=False, sparse_weights=False))
+            if reference is None or not validate_engine(engine, reference, tolerance=args.validate_tol):
+                sys.exit(1)
+    
+    if up_to_date:
+        sys.exit(0)
+    
+    # 每个DLA核心一个引擎（best_dla0.engine, best_dla1.engine），运行时可与GPU轮流处理帧
+    stem = os.path.splitext(engine_file)[0]
+    for core in range(args.dla):
+        dla_engine = build_engine(onnx_file, f"{stem}_dla{core}.engine",
+                                  calib_cache=f"{engine_file}.calib.cache", dla_core=core,
+                                  timing_cache=args.timing_cache, **build_options)
+        if dla_engine is None:
+            sys.exit(1)
+    
+    if build_key is not None:
+        with open(sidecar_path(engine_file, 'build'), 'w') as f:
+            json.dump(build_key, f, indent=2)
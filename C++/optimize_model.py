@@ -1,43 +1,229 @@
 #!/usr/bin/env python3
-"""优化模型脚本 - 降低输入尺寸以提高性能"""
-from ultralytics import YOLO
+"""
+优化模型脚本 - 降低输入尺寸以提高性能
+使用方法: python3 optimize_model.py [--model best.pt] [--imgsz 512] [--format onnx|onnx-int8|engine-int8] [--calib PATH] [--dynamic]
+
+ultralytics/torch/onnxruntime等重量级依赖只在实际导出时才导入，--help等不会付出导入开销。
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
 import sys
+import tempfile
+
+def load_yolo(model_path):
+    """加载YOLO模型（延迟导入ultralytics，在Jetson上导入torch可能需要10秒）"""
+    from ultralytics import YOLO
+    print(f"加载模型: {model_path}")
+    return YOLO(model_path)
+
+def export_in_tempdir(model_path, output_path, **export_args):
+    """
+    在临时目录中导出模型并移动到output_path
+
+    Ultralytics总是导出到 <stem>.onnx / <stem>.engine，直接在模型目录导出会覆盖
+    config.yaml默认加载的 best.onnx / best.engine。
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_model = os.path.join(tmp_dir, os.path.basename(model_path))
+        shutil.copy2(model_path, tmp_model)
+        model = load_yolo(tmp_model)
+        exported_path = model.export(**export_args)
+        shutil.move(exported_path, output_path)
+
+def export_onnx(model_path, imgsz, output_path, key, dynamic=False):
+    """
+    导出FP32 ONNX，并写出供convert_to_tensorrt.py使用的元数据
+
+    dynamic为True时batch和输入尺寸都是动态维度，convert_to_tensorrt.py会为其创建优化配置，
+    用一个引擎覆盖416~640输入尺寸和batch 1~4。
+    """
+    print(f"导出为ONNX (输入尺寸: {imgsz}x{imgsz}{'，动态形状' if dynamic else ''})...")
+    export_in_tempdir(model_path, output_path, format='onnx', imgsz=imgsz, simplify=True, dynamic=dynamic)
+
+    # 记录导出参数，convert_to_tensorrt.py据此判断引擎是否需要重新构建
+    with open(output_path + '.export.json', 'w') as f:
+        json.dump({'source': model_path, 'imgsz': imgsz, 'simplify': True, 'dynamic': dynamic, 'key': key},
+                  f, indent=2)
+
+    print()
+    print(f"✓ 模型已导出: {output_path}")
+
+def strip_engine_metadata(engine_path):
+    """
+    去掉Ultralytics写在引擎文件开头的元数据头（4字节小端长度 + JSON），只保留TensorRT序列化数据
+
+    C++端直接把整个文件交给deserializeCudaEngine，带元数据头的文件无法加载。
+    元数据另存为 <engine>.ultralytics.json。
+    """
+    with open(engine_path, 'rb') as f:
+        data = f.read()
+    length = int.from_bytes(data[:4], byteorder='little', signed=True)
+    if length <= 0 or length + 4 > len(data):
+        return
+    try:
+        metadata = json.loads(data[4:4 + length].decode())
+    except (UnicodeDecodeError, ValueError):
+        # 旧版本Ultralytics不写元数据头
+        return
+    with open(engine_path + '.ultralytics.json', 'w') as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    with open(engine_path, 'wb') as f:
+        f.write(data[4 + length:])
+
+def export_int8_engine(model_path, imgsz, calib_yaml, output_path):
+    """Ultralytics导出时完成INT8 PTQ校准，直接得到TensorRT引擎"""
+    print(f"导出为TensorRT INT8引擎 (输入尺寸: {imgsz}x{imgsz})...")
+    export_in_tempdir(model_path, output_path, format='engine', imgsz=imgsz, int8=True,
+                      data=calib_yaml, workspace=4, simplify=True, dynamic=False)
+    strip_engine_metadata(output_path)
+
+    print()
+    print(f"✓ 引擎已导出: {output_path}")
+
+def quantize_onnx(onnx_path, qdq_path, calib_dir, imgsz, meta):
+    """
+    onnxruntime静态量化，输出QDQ格式的ONNX，TensorRT解析时按其中的量化参数构建INT8引擎
+
+    逐通道DequantizeLinear的axis属性需要opset 13，Ultralytics默认导出的低版本opset模型先升级。
+    """
+    import cv2
+    import numpy as np
+    import onnx
+    from onnx import version_converter
+    import onnxruntime as ort
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+
+    class FrameDataReader(CalibrationDataReader):
+        """逐帧读取校准图像（与C++端相同的预处理），最多limit帧"""
+
+        def __init__(self, calib_dir, input_name, imgsz, limit=200):
+            names = sorted(n for n in os.listdir(calib_dir)
+                           if n.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')))
+            self.files = iter([os.path.join(calib_dir, n) for n in names][:limit])
+            self.input_name = input_name
+            self.imgsz = imgsz
+
+        def get_next(self):
+            for path in self.files:
+                image = cv2.imread(path)
+                if image is None:
+                    continue
+                image = cv2.cvtColor(cv2.resize(image, (self.imgsz, self.imgsz)), cv2.COLOR_BGR2RGB)
+                blob = (image.astype(np.float32) / 255.0).transpose(2, 0, 1)[np.newaxis]
+                return {self.input_name: blob}
+            return None
+
+    print(f"INT8静态量化 (校准数据: {calib_dir})...")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = onnx.load(onnx_path)
+        opset = next((o.version for o in model.opset_import if o.domain in ('', 'ai.onnx')), 0)
+        if opset < 13:
+            print(f"  升级opset {opset} -> 13（逐通道量化需要）")
+            onnx_path = os.path.join(tmp_dir, 'opset13.onnx')
+            onnx.save(version_converter.convert_version(model, 13), onnx_path)
+        del model
+
+        session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        reader = FrameDataReader(calib_dir, session.get_inputs()[0].name, imgsz)
+        del session
+        # TensorRT要求对称量化，且只接受INT8 Q/DQ，bias保持FP32（不量化为INT32）
+        quantize_static(onnx_path, qdq_path, reader,
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QInt8, weight_type=QuantType.QInt8,
+                        extra_options={'ActivationSymmetric': True, 'WeightSymmetric': True,
+                                       'QuantizeBias': False})
+    with open(qdq_path + '.export.json', 'w') as f:
+        json.dump(dict(meta, quantize='qdq-int8', opset=max(opset, 13), quantize_bias=False), f, indent=2)
+    print(f"✓ 量化模型已导出: {qdq_path}")
+
+def qdq_is_current(qdq_path):
+    """旧版本量化的模型（opset < 13的逐通道DQ、INT32 bias）TensorRT无法使用，需要重新量化"""
+    meta_path = qdq_path + '.export.json'
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('opset', 0) >= 13 and meta.get('quantize_bias') is False and 'fp32_onnx' in meta
+
+def main():
+    parser = argparse.ArgumentParser(description='模型优化工具 - 将YOLO模型导出为更小的输入尺寸以提高性能')
+    parser.add_argument('--model', default='best.pt', help='模型路径（默认 best.pt）')
+    parser.add_argument('--imgsz', type=int, choices=[640, 512, 416], default=512,
+                        help='输入尺寸: 640原始 / 512推荐（性能和精度平衡）/ 416最快（精度可能下降），默认512')
+    parser.add_argument('--format', choices=['onnx', 'onnx-int8', 'engine-int8'], default='onnx',
+                        help='导出格式: onnx FP32（默认，由TensorRT转换）/ '
+                             'onnx-int8 QDQ量化ONNX（需要校准图像目录）/ '
+                             'engine-int8 TensorRT INT8引擎（需要校准数据集yaml）')
+    parser.add_argument('--calib', help='校准数据: onnx-int8为图像目录，engine-int8为数据集yaml')
+    parser.add_argument('--dynamic', action='store_true',
+                        help='导出动态batch和输入尺寸的ONNX（onnx/onnx-int8），由convert_to_tensorrt.py按 '
+                             '--min/--opt/--max 构建一个引擎；当前C++检测器只支持固定形状引擎')
+    args = parser.parse_args()
+
+    print("=== 模型优化工具 ===")
+    print("将YOLO模型导出为更小的输入尺寸以提高性能")
+    print()
+
+    model_path = args.model
+    imgsz = args.imgsz
 
-print("=== 模型优化工具 ===")
-print("将YOLO模型导出为更小的输入尺寸以提高性能")
-print()
+    if not os.path.exists(model_path):
+        print(f"错误: 文件不存在: {model_path}")
+        sys.exit(1)
 
-model_path = input("输入模型路径 (如: best.pt，直接回车使用 best.pt): ").strip()
-if not model_path:
-    model_path = "best.pt"
+    if args.dynamic and args.format == 'engine-int8':
+        print("错误: --dynamic 只支持 onnx / onnx-int8 格式")
+        sys.exit(1)
 
-if not os.path.exists(model_path):
-    print(f"错误: 文件不存在: {model_path}")
-    sys.exit(1)
+    if args.format != 'onnx' and not (args.calib and os.path.exists(args.calib)):
+        print(f"错误: 校准数据不存在: {args.calib}（{args.format} 需要 --calib）")
+        sys.exit(1)
 
-print()
-print("选择输入尺寸:")
-print("1. 640x640 (原始，性能要求高)")
-print("2. 512x512 (推荐，性能和精度平衡) ⭐")
-print("3. 416x416 (最快，精度可能下降)")
-print()
+    # 缓存键: (模型修改时间, 输入尺寸, simplify, dynamic)，相同配置且ONNX比.pt新时跳过导出
+    model_mtime = os.path.getmtime(model_path)
+    key = hashlib.sha1(f"{model_mtime}|{imgsz}|simplify{'|dynamic' if args.dynamic else ''}".encode()).hexdigest()[:12]
+    stem = os.path.splitext(model_path)[0]
+    output_path = f"{stem}_{imgsz}_{key}{'_dynamic' if args.dynamic else ''}.onnx"
 
-choice = input("选择 (1/2/3，默认2): ").strip() or "2"
+    if args.format == 'engine-int8':
+        output_path = f"{stem}_{imgsz}_{key}_int8.engine"
+        export_int8_engine(model_path, imgsz, args.calib, output_path)
+        print()
+        print("下一步:")
+        print(f"1. 将 config/config.yaml 中的 model.path 改为 {output_path}")
+        return
 
-size_map = {"1": 640, "2": 512, "3": 416}
-imgsz = size_map.get(choice, 512)
+    if os.path.exists(output_path) and os.path.getmtime(output_path) > model_mtime:
+        print(f"✓ 模型未变化，跳过导出: {output_path}")
+    else:
+        export_onnx(model_path, imgsz, output_path, key, dynamic=args.dynamic)
 
-print()
-print(f"加载模型: {model_path}")
-model = YOLO(model_path)
+    if args.format == 'onnx-int8':
+        qdq_path = output_path.replace('.onnx', '_int8.onnx')
+        if (os.path.exists(qdq_path) and os.path.getmtime(qdq_path) > os.path.getmtime(output_path)
+                and qdq_is_current(qdq_path)):
+            print(f"✓ 量化模型未变化，跳过量化: {qdq_path}")
+        else:
+            # 记录未量化的源ONNX（相对量化模型所在目录），convert_to_tensorrt.py --validate用它构建FP32参考引擎
+            fp32_onnx = os.path.relpath(output_path, os.path.dirname(qdq_path) or '.')
+            meta = {'source': model_path, 'imgsz': imgsz, 'simplify': True, 'dynamic': args.dynamic,
+                    'key': key, 'fp32_onnx': fp32_onnx}
+            quantize_onnx(output_path, qdq_path, args.calib, imgsz, meta)
+        output_path = qdq_path
 
-print(f"导出为ONNX (输入尺寸: {imgsz}x{imgsz})...")
-output_path = model.export(format='onnx', imgsz=imgsz, simplify=True)
+    print()
+    print("下一步:")
+    print(f"1. 构建引擎: python3 convert_to_tensorrt.py {output_path}"
+          f"{' --int8' if args.format == 'onnx-int8' else ''}"
+          f"{' --min 1,3,416,416 --max 4,3,640,640' if args.dynamic else ''}")
+    if args.dynamic:
+        print("   注意: 当前C++检测器按固定形状读取绑定维度，尚不能加载动态形状引擎")
+    print(f"2. 将 config/config.yaml 中的 model.path 改为 {output_path}")
+    print(f"3. 预期性能提升: {1.6 if imgsz == 512 else 2.4 if imgsz == 416 else 1.0:.1f}x")
 
-print()
-print(f"✓ 模型已导出: {output_path}")
-print()
-print("下一步:")
-print(f"1. 删除旧的引擎文件: rm -f best.engine")
-print("2. 重新运行程序，会自动生成新的TensorRT引擎")
-print(f"3. 预期性能提升: {1.6 if imgsz == 512 else 2.4 if imgsz == 416 else 1.0:.1f}x")
+if __name__ == '__main__':
+    main()